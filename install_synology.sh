@@ -68,6 +68,17 @@ done
 # Reload systemd
 sudo systemctl daemon-reload
 
+# Allow the service user to power off via logind (used by the shutdown button)
+sudo tee /etc/polkit-1/rules.d/50-photo-frame-poweroff.rules > /dev/null << EOF
+polkit.addRule(function(action, subject) {
+    if ((action.id == "org.freedesktop.login1.power-off" ||
+         action.id == "org.freedesktop.login1.power-off-multiple-sessions") &&
+        subject.user == "$USER") {
+        return polkit.Result.YES;
+    }
+});
+EOF
+
 echo
 echo "=== Configuration Required ==="
 echo
@@ -4,16 +4,28 @@ Digital Photo Frame Application
 A simple digital photo frame for Raspberry Pi Zero 2 W
 """
 
+import gc
+import itertools
 import os
 import sys
 import time
 import random
 import logging
+import queue
+import threading
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import yaml
 import pygame
-from PIL import Image
+from PIL import Image, ImageOps
+
+
+# Resampling filters selectable via slideshow.filter
+RESAMPLE_FILTERS = {
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
 
 
 class PhotoFrame:
@@ -32,9 +44,17 @@ class PhotoFrame:
         self.fullscreen = self.config.get('display', {}).get('fullscreen', True)
         self.width = self.config.get('display', {}).get('width', 800)
         self.height = self.config.get('display', {}).get('height', 600)
+        render_width = self.config.get('display', {}).get('render_width')
+        render_height = self.config.get('display', {}).get('render_height')
         
         # Setup display
-        if self.fullscreen:
+        if render_width and render_height:
+            # Render at a lower resolution and let SDL scale it up on the GPU,
+            # so decoding, resizing and blitting all work on fewer pixels
+            flags = pygame.SCALED | (pygame.FULLSCREEN if self.fullscreen else 0)
+            self.screen = pygame.display.set_mode((render_width, render_height), flags)
+            self.width, self.height = render_width, render_height
+        elif self.fullscreen:
             self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
             self.width, self.height = self.screen.get_size()
         else:
@@ -48,27 +68,39 @@ class PhotoFrame:
         self.shuffle = self.config.get('slideshow', {}).get('shuffle', True)
         self.transition = self.config.get('slideshow', {}).get('transition', 'fade')
         self.fade_duration = self.config.get('slideshow', {}).get('fade_duration', 1.0)
+        resample_filter = self.config.get('slideshow', {}).get('filter', 'bicubic').lower()
+        if resample_filter not in RESAMPLE_FILTERS:
+            self.logger.warning(f"Unknown filter '{resample_filter}', using bicubic")
+            resample_filter = 'bicubic'
+        self.resample = RESAMPLE_FILTERS[resample_filter]
         
         # Get image settings
         self.image_dir = Path(self.config.get('images', {}).get('directory', './images'))
         self.recursive = self.config.get('images', {}).get('recursive', True)
-        self.extensions = self.config.get('images', {}).get('extensions', 
-                                                           ['.jpg', '.jpeg', '.png', '.bmp', '.gif'])
+        extensions = self.config.get('images', {}).get('extensions',
+                                                      ['.jpg', '.jpeg', '.png', '.bmp', '.gif'])
+        # Lower-cased once so every scan matches case-insensitively
+        self.extensions = frozenset(ext.lower() for ext in extensions)
         
         # Load images
-        self.images = self._load_image_list()
-        if not self.images:
+        images = self._load_image_list()
+        if not images:
             self.logger.error(f"No images found in {self.image_dir}")
             sys.exit(1)
         
-        self.logger.info(f"Loaded {len(self.images)} images from {self.image_dir}")
+        self.logger.info(f"Loaded {len(images)} images from {self.image_dir}")
         
-        if self.shuffle:
-            random.shuffle(self.images)
-        
-        self.current_index = 0
+        self._set_images(images)
         self.running = True
         self.clock = pygame.time.Clock()
+        
+        # Preload pipeline: a worker thread decodes and scales upcoming images
+        # while the current one is on screen. The generation counter lets the
+        # main loop drop frames queued before an image list reload.
+        self._images_lock = threading.Lock()
+        self._generation = 0
+        self._preload_queue = queue.Queue(maxsize=2)
+        self._preload_thread = None
     
     def _load_config(self, config_path: str) -> dict:
         """Load configuration from YAML file."""
@@ -101,60 +133,107 @@ class PhotoFrame:
             self.image_dir.mkdir(parents=True, exist_ok=True)
             return images
         
-        if self.recursive:
-            for ext in self.extensions:
-                images.extend(self.image_dir.rglob(f"*{ext}"))
-                images.extend(self.image_dir.rglob(f"*{ext.upper()}"))
-        else:
-            for ext in self.extensions:
-                images.extend(self.image_dir.glob(f"*{ext}"))
-                images.extend(self.image_dir.glob(f"*{ext.upper()}"))
+        # Single scandir walk with a case-insensitive extension match
+        extensions = self.extensions
+        stack = [self.image_dir]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive:
+                            stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions:
+                        images.append(Path(entry.path))
         
         return sorted(images)
     
-    def _load_and_scale_image(self, image_path: Path) -> Optional[pygame.Surface]:
-        """Load and scale image to fit screen while maintaining aspect ratio."""
+    def _set_images(self, images: List[Path]):
+        """Install a new image list and the order to show it in."""
+        # The list itself never changes order; slides are picked through an
+        # index order so upcoming images can be looked up without touching it
+        self.images = tuple(images)
+        if self.shuffle:
+            self._order = random.sample(range(len(self.images)), len(self.images))
+        else:
+            self._order = list(range(len(self.images)))
+        self._order_iter = itertools.cycle(self._order)
+    
+    def _load_and_scale_image(self, image_path: Path) -> Optional[Tuple[bytes, Tuple[int, int]]]:
+        """Load and scale image to fit screen while maintaining aspect ratio.
+        
+        Returns the raw RGB pixel data and its size. This runs on the preload
+        thread, so it must not touch the display.
+        """
         try:
             # Load image with PIL
             img = Image.open(image_path)
             
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
+            # Palette images would be resized with NEAREST, so convert them first
+            if img.mode in ('1', 'P'):
                 img = img.convert('RGB')
             
-            # Get image dimensions
-            img_width, img_height = img.size
-            
-            # Calculate scaling to fit screen while maintaining aspect ratio
-            scale_w = self.width / img_width
-            scale_h = self.height / img_height
-            scale = min(scale_w, scale_h)
-            
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
+            # Scale to fit screen while maintaining aspect ratio. thumbnail()
+            # drafts JPEGs at a reduced DCT scale and does a reduce() pre-pass
+            # before resizing, so the filter only sees a small intermediate.
+            img.thumbnail((self.width, self.height), self.resample, reducing_gap=3.0)
             
-            # Resize image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+            # thumbnail() only shrinks; scale smaller photos up to fill the screen
+            if img.width < self.width and img.height < self.height:
+                img = ImageOps.contain(img, (self.width, self.height), self.resample)
             
-            # Convert PIL image to pygame surface
-            img_str = img.tobytes()
-            pygame_image = pygame.image.fromstring(img_str, img.size, 'RGB')
+            # Convert to RGB if necessary
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
             
-            return pygame_image
+            return img.tobytes(), img.size
             
         except Exception as e:
             self.logger.error(f"Error loading image {image_path}: {e}")
             return None
     
+    def _to_surface(self, frame: Tuple[bytes, Tuple[int, int]]) -> pygame.Surface:
+        """Wrap preloaded RGB pixel data in a surface in the display's pixel format."""
+        data, size = frame
+        # frombuffer wraps the bytes without another copy; convert() once so
+        # later blits don't pay for a per-pixel format conversion
+        return pygame.image.frombuffer(data, size, 'RGB').convert()
+    
+    def _preload_worker(self):
+        """Decode and scale upcoming images ahead of time."""
+        while self.running:
+            with self._images_lock:
+                if not self.images:
+                    image_path = None
+                else:
+                    image_path = self.images[next(self._order_iter)]
+                generation = self._generation
+            
+            if image_path is None:
+                time.sleep(0.5)
+                continue
+            
+            frame = self._load_and_scale_image(image_path)
+            
+            # Wait for a free slot, but keep an eye on shutdown
+            while self.running:
+                try:
+                    self._preload_queue.put((generation, image_path, frame), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+    
+    def _centered_pos(self, surface: pygame.Surface) -> Tuple[int, int]:
+        """Return the top-left position that centers surface on screen."""
+        return ((self.width - surface.get_width()) // 2,
+                (self.height - surface.get_height()) // 2)
+    
     def _draw_image(self, surface: pygame.Surface, alpha: int = 255):
         """Draw image centered on screen with optional alpha."""
         # Fill screen with black
         self.screen.fill((0, 0, 0))
         
         # Calculate centered position
-        img_rect = surface.get_rect()
-        x = (self.width - img_rect.width) // 2
-        y = (self.height - img_rect.height) // 2
+        x, y = self._centered_pos(surface)
         
         # Apply alpha if needed
         if alpha < 255:
@@ -176,56 +255,77 @@ class PhotoFrame:
         fps = 30
         steps = int(self.fade_duration * fps)
         
-        for i in range(steps + 1):
-            alpha = int((i / steps) * 255)
-            
-            # Fill screen with black
-            self.screen.fill((0, 0, 0))
-            
-            # Draw old image
-            old_rect = old_surface.get_rect()
-            old_x = (self.width - old_rect.width) // 2
-            old_y = (self.height - old_rect.height) // 2
-            self.screen.blit(old_surface, (old_x, old_y))
-            
-            # Draw new image with alpha (create fresh copy each iteration)
-            new_surf_alpha = new_surface.copy()
-            new_surf_alpha.set_alpha(alpha)
-            new_rect = new_surf_alpha.get_rect()
-            new_x = (self.width - new_rect.width) // 2
-            new_y = (self.height - new_rect.height) // 2
-            self.screen.blit(new_surf_alpha, (new_x, new_y))
-            
-            pygame.display.flip()
-            
-            # Check for quit events during transition
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    return
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_ESCAPE or event.key == pygame.K_q:
+        # Render the old image on black once, offscreen
+        background = pygame.Surface((self.width, self.height)).convert()
+        background.fill((0, 0, 0))
+        background.blit(old_surface, self._centered_pos(old_surface))
+        
+        # Copy the new image once; set_alpha() only updates surface metadata,
+        # so the blit list stays valid for every step. Surface alpha onto an
+        # opaque target is already a SIMD path in pygame: rebuilding scaled
+        # copies with BLEND_RGB_MULT/BLEND_RGB_ADD each step is far slower.
+        fade_buf = new_surface.copy()
+        fade_blits = [(background, (0, 0)), (fade_buf, self._centered_pos(new_surface))]
+        
+        # Batch the per-step blits into one call; fblits() is pygame-ce only
+        if hasattr(self.screen, 'fblits'):
+            blit_batch = self.screen.fblits
+        else:
+            blit_batch = lambda seq: self.screen.blits(seq, doreturn=False)
+        
+        # The fade loop creates no reference cycles, so keep the cyclic GC from
+        # stalling the animation
+        gc.disable()
+        try:
+            for i in range(steps + 1):
+                alpha = int((i / steps) * 255)
+                
+                # Draw old image on black, then new image with alpha on top
+                fade_buf.set_alpha(alpha)
+                blit_batch(fade_blits)
+                
+                pygame.display.flip()
+                
+                # Check for quit events during transition
+                # (filtered in C so unrelated events aren't turned into objects)
+                for event in pygame.event.get(eventtype=[pygame.QUIT, pygame.KEYDOWN]):
+                    if event.type == pygame.QUIT:
                         self.running = False
                         return
-            
-            self.clock.tick(fps)
+                    elif event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_ESCAPE or event.key == pygame.K_q:
+                            self.running = False
+                            return
+                
+                self.clock.tick(fps)
+        finally:
+            gc.enable()
     
     def display_next_image(self, previous_surface: Optional[pygame.Surface] = None):
         """Display the next image in the slideshow."""
         if not self.images:
             return None
         
-        # Get next image
-        image_path = self.images[self.current_index]
-        self.logger.info(f"Displaying: {image_path.name}")
+        # Get next preloaded image, skipping ones that failed to load. Give
+        # up after a full round of failures so the event loop keeps running.
+        failures = 0
+        while True:
+            generation, image_path, frame = self._preload_queue.get()
+            if generation != self._generation:
+                # Queued before the image list was reloaded
+                continue
+            
+            if frame is not None:
+                break
+            
+            failures += 1
+            if failures >= len(self.images):
+                self.logger.warning("No image could be loaded, keeping the current one")
+                return previous_surface
         
-        # Load and scale image
-        surface = self._load_and_scale_image(image_path)
+        self.logger.info(f"Displaying: {image_path.name}")
         
-        if surface is None:
-            # Skip to next image if loading failed
-            self.current_index = (self.current_index + 1) % len(self.images)
-            return self.display_next_image(previous_surface)
+        surface = self._to_surface(frame)
         
         # Apply transition
         if self.transition == 'fade' and previous_surface is not None:
@@ -233,15 +333,15 @@ class PhotoFrame:
         else:
             self._draw_image(surface)
         
-        # Update index for next image
-        self.current_index = (self.current_index + 1) % len(self.images)
-        
         return surface
     
     def run(self):
         """Main loop for the photo frame."""
         self.logger.info("Starting photo frame...")
         
+        self._preload_thread = threading.Thread(target=self._preload_worker, daemon=True)
+        self._preload_thread.start()
+        
         current_surface = None
         last_update = time.time()
         
@@ -259,9 +359,9 @@ class PhotoFrame:
                         last_update = time.time()
                     elif event.key == pygame.K_r:
                         # Reload image list
-                        self.images = self._load_image_list()
-                        if self.shuffle:
-                            random.shuffle(self.images)
+                        with self._images_lock:
+                            self._set_images(self._load_image_list())
+                            self._generation += 1
                         self.logger.info(f"Reloaded {len(self.images)} images")
             
             # Check if it's time to display next image
@@ -278,6 +378,9 @@ class PhotoFrame:
     def cleanup(self):
         """Cleanup resources."""
         self.logger.info("Shutting down photo frame...")
+        self.running = False
+        if self._preload_thread is not None:
+            self._preload_thread.join(timeout=2)
         pygame.quit()
 
 
@@ -11,12 +11,16 @@ import logging
 import requests
 import yaml
 import hashlib
+import shutil
 import time
+import math
+from collections import Counter, deque
 from pathlib import Path
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from urllib.parse import urljoin, urlparse
-import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 # Configure logging
 logging.basicConfig(
@@ -25,11 +29,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Threads fetching album pages concurrently when the total is known
+_LIST_PREFETCH_WORKERS = 3
+
 
 class SynologyPhotosClient:
     """Client for Synology Photos API via public share links."""
     
-    def __init__(self, base_url: str, share_url: str, passphrase: str):
+    def __init__(self, base_url: str, share_url: str, passphrase: str,
+                 max_connections: int = 8):
         self.base_url = base_url.rstrip('/')
         self.share_url = share_url
         self.passphrase = passphrase
@@ -38,6 +46,12 @@ class SynologyPhotosClient:
             'User-Agent': 'Mozilla/5.0 (X11; Linux armv7l) AppleWebKit/537.36'
         })
         
+        # Keep connections alive across parallel downloads; the pool must be
+        # at least as large as the number of threads sharing the session
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
         # Extract share token from URL
         self.share_token = self._extract_share_token(share_url)
         self._sharing_id = None
@@ -109,8 +123,22 @@ class SynologyPhotosClient:
         offset = 0
         limit = 100
         
+        prefetched = deque([self.list_items(offset=offset, limit=limit)])
+        total = prefetched[0].get('total') if prefetched[0] else None
+        if total and total > limit:
+            # The server reported the album size, so fetch the remaining pages
+            # concurrently instead of one round trip at a time
+            with ThreadPoolExecutor(max_workers=_LIST_PREFETCH_WORKERS) as executor:
+                prefetched.extend(executor.map(
+                    lambda page_offset: self.list_items(offset=page_offset, limit=limit),
+                    range(limit, total, limit)
+                ))
+        
         while True:
-            data = self.list_items(offset=offset, limit=limit)
+            if prefetched:
+                data = prefetched.popleft()
+            else:
+                data = self.list_items(offset=offset, limit=limit)
             if not data:
                 break
             
@@ -132,7 +160,8 @@ class SynologyPhotosClient:
                 break
             
             offset += limit
-            time.sleep(0.5)  # Be nice to the server
+            if not prefetched:
+                time.sleep(0.05)  # Be nice to the server
         
         logger.info(f"Total items fetched: {len(all_items)}")
         return all_items
@@ -157,12 +186,11 @@ class SynologyPhotosClient:
             resp = self.session.post(url, data=data, stream=True)
             resp.raise_for_status()
             
-            # Write to file
+            # Stream to file in a C-level copy loop
             output_path.parent.mkdir(parents=True, exist_ok=True)
+            resp.raw.decode_content = True
             with open(output_path, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+                shutil.copyfileobj(resp.raw, f, length=64 * 1024)
             
             logger.info(f"Downloaded item {item_id} ({output_path.name})")
             return True
@@ -180,6 +208,13 @@ class PhotoDatabase:
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         self.conn = sqlite3.connect(db_path)
         self.conn.row_factory = sqlite3.Row
+        self.conn.create_function('LOG', 1, math.log, deterministic=True)
+        
+        # WAL keeps commits cheap on SD cards; mmap avoids read() syscalls
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA mmap_size=67108864')
         self._init_db()
     
     def _init_db(self):
@@ -200,6 +235,12 @@ class PhotoDatabase:
                 last_shown_ts INTEGER
             )
         ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_items_type_shown ON items(type, times_shown)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_items_week ON items(last_shown_week)
+        ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sync_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -214,101 +255,71 @@ class PhotoDatabase:
     
     def update_items(self, items: List[Dict[str, Any]]):
         """Update items in database."""
-        cursor = self.conn.cursor()
         now = datetime.now().isoformat()
+        rows = [(
+            item['id'],
+            item.get('filename', ''),
+            item.get('type', ''),
+            item.get('filesize', 0),
+            item.get('time', 0),
+            now,
+            now
+        ) for item in items]
         
-        for item in items:
-            cursor.execute('''
+        # One prepared statement and one transaction for the whole batch
+        with self.conn:
+            self.conn.executemany('''
                 INSERT INTO items (item_id, filename, type, filesize, taken_time, first_seen, last_seen)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
                 ON CONFLICT(item_id) DO UPDATE SET
                     last_seen=excluded.last_seen,
                     filename=excluded.filename,
                     filesize=excluded.filesize
-            ''', (
-                item['id'],
-                item.get('filename', ''),
-                item.get('type', ''),
-                item.get('filesize', 0),
-                item.get('time', 0),
-                now,
-                now
-            ))
+            ''', rows)
         
-        self.conn.commit()
         logger.info(f"Updated {len(items)} items in database")
     
     def get_weighted_selection(self, count: int, max_show_count: int = 10) -> List[int]:
         """Get a weighted random selection of items."""
         cursor = self.conn.cursor()
         
-        # Get all eligible items with their weights
+        # Weighted random selection without replacement, done in SQLite using
+        # Efraimidis-Spirakis keys: the smallest -ln(U) / weight values win.
+        # Weight is inversely proportional to times shown and doubled if the
+        # item was not shown this week. U is drawn uniformly from (0, 1).
         current_week = datetime.now().strftime('%G-W%V')  # ISO week format
         cursor.execute('''
-            SELECT item_id, times_shown, last_shown_week
+            SELECT item_id
             FROM items
             WHERE type = 'photo' AND times_shown < ?
-        ''', (max_show_count,))
+            ORDER BY -LOG(((random() & 4503599627370495) + 1) / 4503599627370497.0)
+                     / (MAX(1, ? - times_shown)
+                        * CASE WHEN last_shown_week = ? THEN 1 ELSE 2 END)
+            LIMIT ?
+        ''', (max_show_count, max_show_count, current_week, count))
         
-        items = cursor.fetchall()
-        if not items:
+        selected_ids = [row['item_id'] for row in cursor.fetchall()]
+        if not selected_ids:
             logger.warning("No items available for selection")
             return []
         
-        # Calculate weights (inverse of times_shown + time since last shown)
-        weighted_items = []
-        for item in items:
-            item_id = item['item_id']
-            times_shown = item['times_shown'] or 0
-            last_week = item['last_shown_week']
-            
-            # Base weight inversely proportional to times shown
-            weight = max(1, max_show_count - times_shown)
-            
-            # Boost if not shown this week
-            if last_week != current_week:
-                weight *= 2
-            
-            weighted_items.append((item_id, weight))
-        
-        # Perform weighted random selection without replacement
-        selected_ids = []
-        total_weight = sum(w for _, w in weighted_items)
-        
-        for _ in range(min(count, len(weighted_items))):
-            if total_weight <= 0:
-                break
-            
-            # Random selection
-            r = random.random() * total_weight
-            cumsum = 0
-            for idx, (item_id, weight) in enumerate(weighted_items):
-                cumsum += weight
-                if cumsum >= r:
-                    selected_ids.append(item_id)
-                    total_weight -= weight
-                    weighted_items.pop(idx)
-                    break
-        
-        logger.info(f"Selected {len(selected_ids)} items from {len(items)} eligible")
+        logger.info(f"Selected {len(selected_ids)} items")
         return selected_ids
     
     def mark_shown(self, item_ids: List[int]):
         """Mark items as shown in current week."""
-        cursor = self.conn.cursor()
         current_week = datetime.now().strftime('%G-W%V')  # ISO week format
         now_ts = int(time.time())
         
-        for item_id in item_ids:
-            cursor.execute('''
+        with self.conn:
+            self.conn.executemany('''
                 UPDATE items
                 SET times_shown = times_shown + 1,
                     last_shown_week = ?,
                     last_shown_ts = ?
                 WHERE item_id = ?
-            ''', (current_week, now_ts, item_id))
+            ''', [(current_week, now_ts, item_id) for item_id in item_ids])
         
-        self.conn.commit()
         logger.info(f"Marked {len(item_ids)} items as shown")
     
     def record_sync(self, items_fetched: int, items_selected: int, items_downloaded: int, success: bool):
@@ -340,12 +351,14 @@ def sync_photos(config: dict):
     # Extract config
     synology_config = config['synology']
     sync_config = config['sync']
+    download_workers = sync_config.get('download_workers', 4)
     
     # Initialize client
     client = SynologyPhotosClient(
         base_url=synology_config['base_url'],
         share_url=synology_config['share_url'],
-        passphrase=synology_config['share_passphrase']
+        passphrase=synology_config['share_passphrase'],
+        max_connections=max(download_workers, _LIST_PREFETCH_WORKERS)
     )
     
     # Initialize database
@@ -379,28 +392,53 @@ def sync_photos(config: dict):
         photos_dir = Path(sync_config['photos_dir'])
         photos_dir.mkdir(parents=True, exist_ok=True)
         
-        # Clear old photos
-        logger.info("Clearing old photos...")
-        for old_file in photos_dir.glob('*'):
-            if old_file.is_file():
-                old_file.unlink()
-        
-        # Download selected items
-        downloaded_count = 0
+        # Work out where the selected items go
         item_lookup = {item['id']: item for item in items}
+        targets = {}
+        
+        # Items from different folders or cameras can share a file name.
+        # Every item whose name occurs more than once in the album gets its
+        # id as a prefix, so each item maps to the same path on every sync and
+        # parallel downloads never write the same file.
+        name_counts = Counter(item.get('filename') for item in items)
         
         for item_id in selected_ids:
             item = item_lookup.get(item_id)
             if not item:
                 continue
             
-            filename = item.get('filename', f'photo_{item_id}.jpg')
-            output_path = photos_dir / filename
-            
-            if client.download_item(item_id, output_path):
-                downloaded_count += 1
-            
-            time.sleep(0.2)  # Rate limiting
+            filename = item.get('filename')
+            if filename is None:
+                filename = f'photo_{item_id}.jpg'
+            elif name_counts[filename] > 1:
+                filename = f'{item_id}_{filename}'
+            targets[item_id] = photos_dir / filename
+        
+        # Clear old photos that are not part of the new selection
+        logger.info("Clearing old photos...")
+        keep = {output_path.name for output_path in targets.values()}
+        for old_file in photos_dir.glob('*'):
+            if old_file.is_file() and old_file.name not in keep:
+                old_file.unlink()
+        
+        # Skip items already on disk from an earlier sync with the same size
+        downloads = {}
+        for item_id, output_path in targets.items():
+            filesize = item_lookup[item_id].get('filesize')
+            if filesize and output_path.is_file() and output_path.stat().st_size == filesize:
+                continue
+            downloads[item_id] = output_path
+        
+        reused_count = len(targets) - len(downloads)
+        if reused_count:
+            logger.info(f"{reused_count} selected items already downloaded, skipping")
+        
+        # Download selected items
+        # Request latency dominates over bandwidth, so overlap the downloads
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            futures = [executor.submit(client.download_item, item_id, output_path)
+                       for item_id, output_path in downloads.items()]
+            downloaded_count = sum(1 for future in as_completed(futures) if future.result())
         
         # Mark as shown
         db.mark_shown(selected_ids)
@@ -408,7 +446,8 @@ def sync_photos(config: dict):
         # Record sync
         db.record_sync(len(items), len(selected_ids), downloaded_count, True)
         
-        logger.info(f"Sync completed successfully: {downloaded_count}/{len(selected_ids)} downloaded")
+        logger.info(f"Sync completed successfully: {downloaded_count}/{len(downloads)} downloaded, "
+                    f"{reused_count} already present")
         
     except Exception as e:
         logger.error(f"Sync failed: {e}", exc_info=True)
@@ -5,25 +5,262 @@ Serves the viewer HTML and generates a JSON list of photos.
 """
 
 import os
+import re
 import json
+import bisect
+import email.utils
+import hashlib
 import logging
+import mmap
+import signal
+import socket
 import subprocess
 import threading
 import time
 from pathlib import Path
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
+# orjson encodes straight to bytes in C; fall back to the stdlib if missing
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# inotify lets the photo list watcher sleep until the directory changes
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# pydbus lets /shutdown ask logind to power off without forking sudo
+try:
+    from pydbus import SystemBus
+except ImportError:
+    SystemBus = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Photo file extensions served by /list (matched case-insensitively)
+_PHOTO_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+
+# Content types for served photos
+_CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp'
+}
+
+
+def _is_photo_name(name):
+    """Return True if the file name has one of the photo extensions.
+    
+    Hidden files (e.g. macOS "._" resource forks on SMB shares) are left out,
+    since serve_photo() refuses names starting with a dot.
+    """
+    # One endswith() call on the lowered name beats slicing off the extension
+    return not name.startswith('.') and name.lower().endswith(_PHOTO_SUFFIXES)
+
+
+# Pre-serialized headers for the photo responses
+_CONTENT_TYPE_HEADERS = {
+    ext: b'Content-Type: %s\r\n' % content_type.encode('ascii')
+    for ext, content_type in _CONTENT_TYPES.items()
+}
+_DEFAULT_CONTENT_TYPE_HEADER = b'Content-Type: application/octet-stream\r\n'
+_SERVER_HEADER = ('Server: %s %s\r\n' % (SimpleHTTPRequestHandler.server_version,
+                                         SimpleHTTPRequestHandler.sys_version)).encode('latin-1')
+
+# socket.sendfile() silently falls back to read()+send() without it
+_HAS_SENDFILE = hasattr(os, 'sendfile')
+
+# Linux only; other platforms send headers and body uncorked
+_TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
+# Per-request access logging is off unless ACCESS_LOG is set; errors are
+# always logged
+_ACCESS_LOG = bool(os.environ.get('ACCESS_LOG'))
+
+# Single byte range in a Range header, e.g. "bytes=0-1023" or "bytes=-500"
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class ViewerPage:
+    """The viewer HTML, read once and served from memory."""
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        # (content, etag, last_modified), swapped as a whole on reload
+        self.state = (None, '', '')
+        self.reload()
+    
+    def reload(self):
+        """Read the viewer HTML from disk."""
+        try:
+            content = self.path.read_bytes()
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            logger.warning(f"Viewer not found: {self.path}")
+            self.state = (None, '', '')
+            return
+        
+        etag = '"%s"' % hashlib.blake2b(content, digest_size=8).hexdigest()
+        # A memoryview lets handlers send the page without copying it
+        self.state = (memoryview(content), etag, email.utils.formatdate(mtime, usegmt=True))
+        logger.info(f"Loaded viewer from {self.path}")
+
+
+class PhotoList:
+    """Encoded /list response, kept up to date by a background watcher."""
+    
+    def __init__(self, photos_dir, poll_interval=1.0):
+        self.photos_dir = photos_dir
+        self.poll_interval = poll_interval
+        # Sorted photo file names, only touched by the watcher thread
+        self._names = []
+        # (body, etag, count), swapped as a whole so handlers never lock.
+        # None until the watcher thread has done its initial scan.
+        self.state = None
+        self._ready = threading.Event()
+    
+    def rebuild(self):
+        """Rescan the photos directory and re-encode the list.
+        
+        Only called from the watcher thread: once at startup and after
+        dropped inotify events (or on every change when polling).
+        """
+        names = []
+        try:
+            # Get all image files in a single directory pass
+            with os.scandir(self.photos_dir) as entries:
+                for entry in entries:
+                    if _is_photo_name(entry.name) and entry.is_file(follow_symlinks=False):
+                        names.append(entry.name)
+        except FileNotFoundError:
+            pass
+        
+        names.sort()
+        self._names = names
+        self._encode()
+    
+    def _add(self, name):
+        """Insert a name into the sorted list; return True if it was new."""
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return False
+        self._names.insert(i, name)
+        return True
+    
+    def _remove(self, name):
+        """Remove a name from the sorted list; return True if it was present."""
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            del self._names[i]
+            return True
+        return False
+    
+    def _encode(self):
+        """Encode the current names as the /list response."""
+        body = _dumps(['/photos/' + name for name in self._names])
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+        self.state = (body, etag, len(self._names))
+        self._ready.set()
+    
+    def wait_ready(self, timeout=10.0):
+        """Wait for the initial scan and return the current state."""
+        self._ready.wait(timeout)
+        return self.state or (b'[]', '""', 0)
+    
+    def start(self):
+        """Start watching the photos directory in a daemon thread."""
+        thread = threading.Thread(target=self._watch, daemon=True)
+        thread.start()
+    
+    def _watch(self):
+        """Rebuild the list whenever the photos directory changes."""
+        if inotify_simple is not None:
+            try:
+                self._watch_inotify()
+                return
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({e}), polling {self.photos_dir}")
+        self._watch_poll()
+    
+    def _watch_inotify(self):
+        """Wait for inotify events on the photos directory."""
+        flags = inotify_simple.flags
+        added = flags.CREATE | flags.MOVED_TO
+        removed = flags.DELETE | flags.MOVED_FROM
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(self.photos_dir, added | removed)
+        # Pick up anything that changed before the watch was in place
+        self.rebuild()
+        
+        while True:
+            # A short read delay batches bursts of events from the syncer
+            events = inotify.read(read_delay=100)
+            
+            # Update the sorted names per event and re-encode once per batch
+            changed = False
+            for event in events:
+                if event.mask & flags.Q_OVERFLOW:
+                    # Events were dropped; only a full rescan is reliable
+                    self.rebuild()
+                    changed = False
+                    break
+                if event.mask & flags.ISDIR or not _is_photo_name(event.name):
+                    continue
+                if event.mask & added:
+                    changed |= self._add(event.name)
+                elif event.mask & removed:
+                    changed |= self._remove(event.name)
+            if changed:
+                self._encode()
+    
+    def _watch_poll(self):
+        """Poll the photos directory mtime when inotify is not available."""
+        last_mtime = None
+        while True:
+            try:
+                mtime = os.stat(self.photos_dir).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != last_mtime:
+                last_mtime = mtime
+                self.rebuild()
+            time.sleep(self.poll_interval)
+
 
 class PhotoFrameHandler(SimpleHTTPRequestHandler):
     """Custom HTTP handler for photo frame."""
     
-    def __init__(self, *args, photos_dir='/srv/frame/photos', viewer_dir='/srv/frame/viewer', **kwargs):
-        self.photos_dir = Path(photos_dir)
-        self.viewer_dir = Path(viewer_dir)
+    # Keep connections open so the viewer fetches the list and photos over
+    # one socket; every response carries a Content-Length for framing
+    protocol_version = 'HTTP/1.1'
+    
+    # No Nagle delay on small JSON responses
+    disable_nagle_algorithm = True
+    
+    # Keep idle connections open past the viewer's default 10 s slide interval
+    # so each slide reuses the socket; this is also the stall limit while
+    # sending a photo. Idle connections hold a pool worker, hence 16 workers.
+    timeout = 30
+    
+    # Pre-serialized status lines and Date header for _write_head()
+    _status_lines = {}
+    _date_header = (0, b'')
+    
+    def __init__(self, *args, photos_dir='/srv/frame/photos/', viewer=None, photo_list=None, **kwargs):
+        # Resolved directory path with a trailing separator, as a plain string
+        self.photos_dir = photos_dir
+        self.viewer = viewer
+        self.photo_list = photo_list
         super().__init__(*args, **kwargs)
     
     def do_GET(self):
@@ -46,27 +283,85 @@ class PhotoFrameHandler(SimpleHTTPRequestHandler):
     
     def do_POST(self):
         """Handle POST requests."""
+        # Discard any request body so it isn't parsed as the next request
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length:
+            self.rfile.read(length)
+        
         if self.path == '/shutdown':
             self.handle_shutdown()
         else:
             self.send_error(404, "Not found")
     
+    def _write_head(self, code, headers, body=b''):
+        """Write the status line, headers and an optional body in a single write.
+        
+        Used on the hot /list and /photos/ paths instead of the
+        send_response()/send_header()/end_headers() sequence.
+        """
+        status_line = self._status_lines.get(code)
+        if status_line is None:
+            status_line = ('%s %d %s\r\n' % (self.protocol_version, code,
+                                              self.responses[code][0])).encode('latin-1')
+            self._status_lines[code] = status_line
+        
+        # Date only changes once a second, so reuse the formatted header
+        now = int(time.time())
+        date_second, date_header = self._date_header
+        if date_second != now:
+            date_header = b'Date: %s\r\n' % email.utils.formatdate(now, usegmt=True).encode('ascii')
+            # Stored on the class so it is shared across connections
+            PhotoFrameHandler._date_header = (now, date_header)
+        
+        if not self.close_connection:
+            headers += b'Connection: keep-alive\r\n'
+        
+        self.log_request(code)
+        self.wfile.write(status_line + _SERVER_HEADER + date_header + headers + b'\r\n' + body)
+    
+    def _not_modified(self, last_modified, etag=None):
+        """Send 304 Not Modified if the client's copy is current."""
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        if etag is not None and if_none_match is not None:
+            fresh = if_none_match == etag
+        else:
+            fresh = self.headers.get('If-Modified-Since') == last_modified
+        if not fresh:
+            return False
+        
+        self.send_response(304)
+        self.send_header('Last-Modified', last_modified)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        return True
+    
     def serve_viewer(self):
         """Serve the viewer HTML."""
-        viewer_file = self.viewer_dir / 'index.html'
-        if not viewer_file.exists():
+        content, etag, last_modified = self.viewer.state
+        if content is None:
             self.send_error(404, "Viewer not found")
             return
         
         try:
-            with open(viewer_file, 'rb') as f:
-                content = f.read()
+            if self._not_modified(last_modified, etag):
+                return
             
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.send_header('Content-Length', len(content))
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('ETag', etag)
             self.end_headers()
-            self.wfile.write(content)
+            self.wfile.flush()
+            self.connection.sendall(content)
         except Exception as e:
             logger.error(f"Error serving viewer: {e}")
             self.send_error(500, str(e))
@@ -74,26 +369,24 @@ class PhotoFrameHandler(SimpleHTTPRequestHandler):
     def serve_photos_json(self):
         """Serve list of photos as JSON."""
         try:
-            if not self.photos_dir.exists():
-                photos = []
-            else:
-                # Get all image files
-                extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
-                photos = []
-                for ext in extensions:
-                    photos.extend([f'/photos/{p.name}' for p in self.photos_dir.glob(f'*{ext}')])
-                    photos.extend([f'/photos/{p.name}' for p in self.photos_dir.glob(f'*{ext.upper()}')])
+            state = self.photo_list.state
+            if state is None:
+                state = self.photo_list.wait_ready()
+            content, etag, count = state
             
-            content = json.dumps(photos).encode('utf-8')
+            etag_header = b'ETag: %s\r\n' % etag.encode('ascii')
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Content-Length', len(content))
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            self.wfile.write(content)
+            # The viewer revalidates on every poll; answer unchanged lists with 304
+            if self.headers.get('If-None-Match') == etag:
+                self._write_head(304, etag_header + b'Cache-Control: no-cache\r\n')
+                return
+            
+            self._write_head(200, b'Content-Type: application/json\r\n'
+                                  b'Content-Length: %d\r\n'
+                                  b'Cache-Control: no-cache\r\n' % len(content) + etag_header,
+                             content)
             
-            logger.info(f"Served {len(photos)} photos in JSON")
+            logger.debug(f"Served {count} photos in JSON")
             
         except Exception as e:
             logger.error(f"Error serving photos JSON: {e}")
@@ -101,40 +394,87 @@ class PhotoFrameHandler(SimpleHTTPRequestHandler):
     
     def serve_photo(self, photo_name):
         """Serve a photo file."""
-        photo_path = self.photos_dir / photo_name
-        
-        if not photo_path.exists() or not photo_path.is_file():
-            self.send_error(404, "Photo not found")
+        # Security check: only plain file names directly inside photos_dir.
+        # A string check is enough here, so no realpath() per request.
+        if '/' in photo_name or '\\' in photo_name or photo_name.startswith('.'):
+            self.send_error(403, "Forbidden")
             return
         
-        # Security check: ensure photo is within photos_dir
-        try:
-            photo_path.resolve().relative_to(self.photos_dir.resolve())
-        except ValueError:
-            self.send_error(403, "Forbidden")
+        photo_path = self.photos_dir + photo_name
+        
+        if not os.path.isfile(photo_path):
+            self.send_error(404, "Photo not found")
             return
         
         try:
-            with open(photo_path, 'rb') as f:
-                content = f.read()
-            
             # Determine content type
-            ext = photo_path.suffix.lower()
-            content_types = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.gif': 'image/gif',
-                '.bmp': 'image/bmp'
-            }
-            content_type = content_types.get(ext, 'application/octet-stream')
+            dot = photo_name.rfind('.')
+            ext = photo_name[dot:].lower() if dot != -1 else ''
+            content_type_header = _CONTENT_TYPE_HEADERS.get(ext, _DEFAULT_CONTENT_TYPE_HEADER)
             
-            self.send_response(200)
-            self.send_header('Content-type', content_type)
-            self.send_header('Content-Length', len(content))
-            self.send_header('Cache-Control', 'public, max-age=3600')
-            self.end_headers()
-            self.wfile.write(content)
+            with open(photo_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+                if self._not_modified(last_modified):
+                    return
+                
+                start, end = 0, size - 1
+                status = 200
+                
+                # Single byte range requests get 206 Partial Content
+                # unless If-Range names an older version of the file, in which
+                # case the client gets the whole new file
+                if_range = self.headers.get('If-Range')
+                if if_range is None or if_range == last_modified:
+                    match = _RANGE_RE.match(self.headers.get('Range', ''))
+                else:
+                    match = None
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                    else:
+                        # Suffix range: the last N bytes
+                        start = max(0, size - int(match.group(2)))
+                    
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', 0)
+                        self.end_headers()
+                        return
+                    status = 206
+                
+                length = end - start + 1
+                
+                headers = (content_type_header
+                           + b'Content-Length: %d\r\n' % length
+                           + b'Accept-Ranges: bytes\r\n')
+                if status == 206:
+                    headers += b'Content-Range: bytes %d-%d/%d\r\n' % (start, end, size)
+                headers += (b'Last-Modified: %s\r\n' % last_modified.encode('ascii')
+                            + b'Cache-Control: public, max-age=3600\r\n')
+                # Cork the socket so the headers and the start of the body
+                # leave in the same segment instead of a short header packet
+                if _TCP_CORK is not None:
+                    self.connection.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 1)
+                try:
+                    self._write_head(status, headers)
+                    
+                    # Let the kernel copy the file straight to the socket
+                    if length and _HAS_SENDFILE:
+                        self.connection.sendfile(f, start, length)
+                    elif length:
+                        # No os.sendfile (Windows): send from a read-only
+                        # mapping instead of reading the file into memory
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            with memoryview(mm) as view:
+                                self.connection.sendall(view[start:start + length])
+                finally:
+                    if _TCP_CORK is not None:
+                        self.connection.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 0)
             
         except Exception as e:
             logger.error(f"Error serving photo {photo_name}: {e}")
@@ -146,14 +486,22 @@ class PhotoFrameHandler(SimpleHTTPRequestHandler):
         
         try:
             # Send response first
+            body = b'Shutdown initiated'
             self.send_response(200)
             self.send_header('Content-type', 'text/plain')
+            self.send_header('Content-Length', len(body))
             self.end_headers()
-            self.wfile.write(b'Shutdown initiated')
+            self.wfile.write(body)
             
             # Schedule shutdown (with delay to allow response to send)
             def delayed_shutdown():
                 time.sleep(2)
+                if SystemBus is not None:
+                    try:
+                        SystemBus().get('.login1')['.Manager'].PowerOff(False)
+                        return
+                    except Exception as e:
+                        logger.error(f"D-Bus power off failed, falling back to sudo: {e}")
                 subprocess.run(['sudo', 'shutdown', '-h', 'now'])
             
             thread = threading.Thread(target=delayed_shutdown)
@@ -164,15 +512,85 @@ class PhotoFrameHandler(SimpleHTTPRequestHandler):
             logger.error(f"Error handling shutdown: {e}")
             self.send_error(500, str(e))
     
+    def address_string(self):
+        """Return the client IP without any reverse DNS lookup."""
+        return self.client_address[0]
+    
+    def log_request(self, code='-', size='-'):
+        """Log the request line only when ACCESS_LOG is set."""
+        if _ACCESS_LOG:
+            super().log_request(code, size)
+    
+    def log_error(self, format, *args):
+        """Log errors, treating idle keep-alive timeouts as access events."""
+        # handle_one_request() reports a connection that stayed idle past
+        # `timeout` through log_error(); that is routine, not an error
+        if format.startswith('Request timed out'):
+            if _ACCESS_LOG:
+                self.log_message(format, *args)
+            return
+        self.log_message(format, *args)
+    
     def log_message(self, format, *args):
         """Override to use Python logging."""
         logger.info(f"{self.address_string()} - {format % args}")
 
 
-def create_handler(photos_dir, viewer_dir):
-    """Create a handler with custom directories."""
+class PhotoFrameServer(ThreadingHTTPServer):
+    """HTTP server that handles requests on a bounded pool of worker threads."""
+    
+    def __init__(self, server_address, handler_class, max_workers=16):
+        # Set up before binding: TCPServer calls server_close() if bind fails
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Open client sockets, so server_close() can wake idle keep-alive workers
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+    
+    def get_request(self):
+        """Accept a connection and tune its socket for small and large responses."""
+        request, client_address = super().get_request()
+        # Bigger send buffer for sendfile(); TCP_NODELAY is set by the handler
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        return request, client_address
+    
+    def process_request(self, request, client_address):
+        """Hand the request to the worker pool instead of a new thread."""
+        self.executor.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        """Handle one connection on a worker, tracking it while it is open."""
+        with self._connections_lock:
+            self._connections.add(request)
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._connections_lock:
+                self._connections.discard(request)
+    
+    def server_close(self):
+        """Stop accepting requests and release the worker pool."""
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        
+        # The interpreter joins pool threads at exit; shut down open sockets
+        # so workers waiting on idle keep-alive connections return at once
+        with self._connections_lock:
+            for request in self._connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def create_handler(photos_dir, viewer, photo_list):
+    """Create a handler with a custom photos directory, viewer page and photo list."""
+    # Resolve once; handlers check containment with a string prefix match
+    photos_dir = os.path.realpath(photos_dir) + os.sep
+    
     def handler(*args, **kwargs):
-        return PhotoFrameHandler(*args, photos_dir=photos_dir, viewer_dir=viewer_dir, **kwargs)
+        return PhotoFrameHandler(*args, photos_dir=photos_dir, viewer=viewer,
+                                 photo_list=photo_list, **kwargs)
     return handler
 
 
@@ -191,19 +609,31 @@ def main():
         photos_dir = config['sync']['photos_dir']
         viewer_dir = str(Path(__file__).parent / 'viewer')
         port = int(os.environ.get('PORT', 8000))
+        http_threads = int(os.environ.get('HTTP_THREADS', 16))
         
         # Ensure directories exist
         Path(photos_dir).mkdir(parents=True, exist_ok=True)
         
-        handler = create_handler(photos_dir, viewer_dir)
-        server = HTTPServer(('0.0.0.0', port), handler)
+        viewer = ViewerPage(Path(viewer_dir) / 'index.html')
+        photo_list = PhotoList(photos_dir)
+        photo_list.start()
+        handler = create_handler(photos_dir, viewer, photo_list)
+        
+        # Re-read the viewer HTML on SIGHUP (systemctl reload)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: viewer.reload())
+        
+        server = PhotoFrameServer(('0.0.0.0', port), handler, max_workers=http_threads)
         
         logger.info(f"Starting photo frame server on port {port}")
         logger.info(f"Photos directory: {photos_dir}")
         logger.info(f"Viewer directory: {viewer_dir}")
         logger.info(f"Open http://localhost:{port}/ to view")
         
-        server.serve_forever()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
         
     except KeyboardInterrupt:
         logger.info("Server stopped by user")